@@ -15,112 +15,118 @@ Usage:
     'configuration' output directory>
 """
 
-import csv, datetime, getopt, os, re, sys, uuid, zipfile
-import xml.etree.cElementTree as et
+import csv, datetime, getopt, os, re, sys, time, uuid, zipfile
+import multiprocessing as mp
 from collections import OrderedDict
+from functools import lru_cache
+
+try:
+    from lxml import etree as et
+    _HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as et
+    _HAVE_LXML = False
+
+# Elements read from the concept XML files: tag -> (key in the parsed file
+# dict, attribute to de-duplicate on). Elements without a de-duplication
+# attribute are kept as a list in document order.
+_CONCEPT_XML_ELEMENTS = dict([
+    ("concept", ("concepts", "concept_id")),
+    ("concept_description", ("descriptions", "uuid")),
+    ("concept_answer", ("answers", "uuid")),
+    ("concept_name", ("names", "uuid")),
+    ("concept_reference_map", ("ref_maps", "uuid")),
+    ("concept_set", ("sets", "uuid")),
+    ("concept_numeric", ("numerics", None)),
+    ("concept_datatype", ("datatypes", None)),
+    ("concept_class", ("classes", None)),
+    ("concept_map_type", ("map_types", None)),
+    ("concept_reference_source", ("ref_sources", None)),
+    ("concept_reference_term", ("ref_terms", None))])
+
+# Parsed concept files and reference dictionaries for the CSV pool workers,
+# which inherit them when forked rather than receiving them with each task
+_pool_parsed_files = None
+_pool_ref_dicts = None
+
+# Concept attributes copied verbatim into the CSV, keyed to their CSV header
+_ATTR_TO_HEADER = dict([("allow_decimal", "Allow decimals"),
+                        ("display_precision", "Display precision"),
+                        ("hi_absolute", "Absolute high"),
+                        ("hi_critical", "Critical high"),
+                        ("hi_normal", "Normal high"),
+                        ("low_absolute", "Absolute low"),
+                        ("low_critical", "Critical low"),
+                        ("low_normal", "Normal low"),
+                        ("precise", "Allow decimals"),
+                        ("retired", "Void/Retire"),
+                        ("units", "Units"),
+                        ("uuid", "Uuid")])
 
 def build_concept_csv(concept_csv, concepts, descriptions, answers, names,
                       ref_maps, sets, ref_dicts):
     # Process all concept objects converting from XML to CSV
-    header_lookup = dict([("allow_decimal", "Allow decimals"),
-                          ("display_precision", "Display precision"),
-                          ("hi_absolute", "Absolute high"),
-                          ("hi_critical", "Critical high"),
-                          ("hi_normal", "Normal high"),
-                          ("low_absolute", "Absolute low"),
-                          ("low_critical", "Critical low"),
-                          ("low_normal", "Normal low"),
-                          ("precise", "Allow decimals"),
-                          ("retired", "Void/Retire"),
-                          ("units", "Units"),
-                          ("uuid", "Uuid")])
-    
-    for key in concepts.keys():
-        concept_csv[key] = dict()
-        for attrib_key in concepts[key].keys():
-            if attrib_key in ["retired", "uuid", "hi_absolute", "units"
-                              "hi_critical", "hi_normal", "low_absolute",
-                              "low_critical", "low_normal", "allow_decimal",
-                              "precise", "display_precision"] :
-                concept_csv[key][header_lookup[attrib_key]] = \
-                concepts[key][attrib_key]
+    datatype_lookup = ref_dicts["Datatype"]
+    class_lookup = ref_dicts["Class"]
+
+    for key, concept in concepts.items():
+        row = concept_csv[key] = dict()
+        for attrib_key, val in concept.items():
+            header = _ATTR_TO_HEADER.get(attrib_key)
+            if header is not None:
+                row[header] = val
             elif attrib_key == "datatype_id":
-                concept_csv[key]["Data type"] = \
-                ref_dicts["Datatype"][concepts[key][attrib_key]]
+                row["Data type"] = datatype_lookup[val]
             elif attrib_key == "class_id":
-                concept_csv[key]["Data class"] = \
-                ref_dicts["Class"][concepts[key][attrib_key]]
-            else:
-                continue
+                row["Data class"] = class_lookup[val]
 
     # Process all description objects converting from XML to CSV
-    for key in descriptions.keys():
-        if "voided" in descriptions[key].keys():
-            if descriptions[key]["voided"] == "true":
-                continue
-        concept_csv[descriptions[key]["concept_id"]]["Description:" + 
-                   descriptions[key]["locale"]] = \
-                   descriptions[key]["description"]
+    for description in descriptions.values():
+        if description.get("voided") == "true":
+            continue
+        concept_csv[description["concept_id"]]["Description:" +
+                   description["locale"]] = description["description"]
 
     # Process all answer objects converting from XML to CSV
-    for key in answers.keys():
-        if "retired" in concepts[answers[key]["answer_concept"]].keys():
-            if concepts[answers[key]["answer_concept"]]["retired"] == "true":
-                continue
-        if not "Answers" in concept_csv[answers[key]["concept_id"]].keys():
-            concept_csv[answers[key]["concept_id"]]["Answers"] = ""
-        concept_csv[answers[key]["concept_id"]]["Answers"] += \
-            concepts[answers[key]["answer_concept"]]["uuid"] + ";"
-    for key in answers.keys():
-        concept_csv[answers[key]["concept_id"]]["Answers"] = \
-        concept_csv[answers[key]["concept_id"]]["Answers"].rstrip(";")
+    for answer in answers.values():
+        answer_concept = concepts[answer["answer_concept"]]
+        if answer_concept.get("retired") == "true":
+            continue
+        concept_csv[answer["concept_id"]].setdefault("Answers", []).\
+            append(answer_concept["uuid"])
 
     # Process all name objects converting from XML to CSV
-    for key in names.keys():
-        if "voided" in names[key].keys():
-            if names[key]["voided"] == "true":
-                continue
-        if not "concept_name_type" in names[key].keys():
-            concept_csv[names[key]["concept_id"]]["Short name:" + \
-                       names[key]["locale"]] = names[key]["name"]
+    for name in names.values():
+        if name.get("voided") == "true":
+            continue
+        # Names without a type are treated as short names
+        if name.get("concept_name_type", "SHORT") == "SHORT":
+            name_header = "Short name:"
         else:
-            if names[key]["concept_name_type"] == "SHORT":
-                concept_csv[names[key]["concept_id"]]["Short name:" + \
-                           names[key]["locale"]] = names[key]["name"]
-            else:
-                concept_csv[names[key]["concept_id"]]["Fully specified name:" \
-                           + names[key]["locale"]] = names[key]["name"]
+            name_header = "Fully specified name:"
+        concept_csv[name["concept_id"]][name_header + name["locale"]] = \
+            name["name"]
 
     # Process all reference map objects converting from XML to CSV
-    for key in ref_maps.keys():
-        if not "Same as mappings" in concept_csv[ref_maps[key]\
-                                                 ["concept_id"]].keys():
-            concept_csv[ref_maps[key]["concept_id"]]["Same as mappings"] = ""
-        concept_csv[ref_maps[key]["concept_id"]]["Same as mappings"] += \
-        ref_dicts["ReferenceTerm"][ref_maps[key]["concept_reference_term_id"]]\
-        + ";"
-    for key in ref_maps.keys():
-        concept_csv[ref_maps[key]["concept_id"]]["Same as mappings"] = \
-        concept_csv[ref_maps[key]["concept_id"]]["Same as mappings"].\
-        rstrip(";")
+    for ref_map in ref_maps.values():
+        concept_csv[ref_map["concept_id"]].\
+            setdefault("Same as mappings", []).\
+            append(ref_dicts["ReferenceTerm"]\
+                   [ref_map["concept_reference_term_id"]])
 
     # Process all set objects converting from XML to CSV
-    for key in sets.keys():
-        if "retired" in concepts[sets[key]["concept_id"]].keys():
-            if concepts[sets[key]["concept_id"]]["retired"] == "true":
-                continue
-        if not "Members" in concept_csv[concepts[sets[key]\
-                            ["concept_set"]]\
-                            ["concept_id"]].keys():
-            concept_csv[concepts[sets[key]["concept_set"]]\
-                        ["concept_id"]]["Members"] = ""
-        concept_csv[concepts[sets[key]["concept_set"]]["concept_id"]]\
-        ["Members"] += concepts[sets[key]["concept_id"]]["uuid"] + ";"
-    for key in sets.keys():
-        concept_csv[concepts[sets[key]["concept_set"]]["concept_id"]]\
-        ["Members"] =\
-        concept_csv[concepts[sets[key]["concept_set"]]["concept_id"]]\
-        ["Members"].rstrip(";")
+    for concept_set in sets.values():
+        member = concepts[concept_set["concept_id"]]
+        if member.get("retired") == "true":
+            continue
+        concept_csv[concepts[concept_set["concept_set"]]["concept_id"]].\
+            setdefault("Members", []).append(member["uuid"])
+
+    # Collapse the accumulated lists into semicolon-separated values
+    for row in concept_csv.values():
+        for field in ("Answers", "Same as mappings", "Members"):
+            if field in row:
+                row[field] = ";".join(row[field])
 
 def build_concept_metadata_mds_header_xml(name, desc, version, datatypes,
                                           classes, map_types, ref_sources,
@@ -199,9 +205,8 @@ def build_concept_metadata_mds_header_xml(name, desc, version, datatypes,
 def build_concept_metadata_mds_header_xml_items(items_el, id_cnt, item_list):
     date_changed_field = "date_changed"
         
-    for key in item_list[0]:
-        if item_list[3] == 0 or \
-            date_changed_field not in item_list[0][key].keys():
+    for key, item in item_list[0].items():
+        if item_list[3] == 0 or date_changed_field not in item:
             date_changed_field = "date_created"
         
         item_el = et.SubElement(items_el,
@@ -210,16 +215,16 @@ def build_concept_metadata_mds_header_xml_items(items_el, id_cnt, item_list):
         id_cnt += 1
         item_el.set("uuid", key)
         id_el = et.SubElement(item_el, "id")
-        id_el.text = item_list[0][key][item_list[1]]
+        id_el.text = item[item_list[1]]
         classname_el = et.SubElement(item_el, "classname")
         classname_el.text = "org.openmrs." + item_list[2]
         dateChanged_el = et.SubElement(item_el, "dateChanged")
         dateChanged_el.set("id", str(id_cnt))
         id_cnt += 1
-        dateChanged_el.text = item_list[0][key][date_changed_field]
+        dateChanged_el.text = item[date_changed_field]
         retired_el = et.SubElement(item_el, "retired")
-        if "retired" in item_list[0][key].keys():
-            retired_el.text = item_list[0][key]["retired"]
+        if "retired" in item:
+            retired_el.text = item["retired"]
         
     return id_cnt
 
@@ -242,62 +247,61 @@ def build_concept_metadata_mds_metadata_xml(datatypes, classes, map_types,
     return list_el
 
 def build_concept_metadata_mds_metadata_xml_items(list_el, id_cnt, item_list):
+    items, cls = item_list[0], item_list[1]
     concept_source_ids = dict()
+
+    # Index the reference sources by id so each term resolves its source
+    # with one lookup; the first source seen for an id wins
+    src_by_id = dict()
+    if cls == "ConceptReferenceTerm":
+        for src in item_list[2].values():
+            src_by_id.setdefault(src["concept_source_id"], src)
     
-    for key in item_list[0]:
-        item_el = et.SubElement(list_el,
-                                "org.openmrs." + item_list[1])
+    for key, item in items.items():
+        item_el = et.SubElement(list_el, "org.openmrs." + cls)
         item_el.set("id", str(id_cnt))
         id_cnt += 1
         item_el.set("uuid", key)
-        for attrib_key in item_list[0][key].keys():
-            if item_list[1] == "ConceptReferenceTerm":
+        for attrib_key, val in item.items():
+            if cls == "ConceptReferenceTerm":
                 if attrib_key == "uuid":
                     continue
                 elif attrib_key == "concept_source_id":
-                    if item_list[0][key][attrib_key] not in \
-                    concept_source_ids.keys():
-                        for src_key in item_list[2]:
-                            if item_list[2][src_key][attrib_key] == \
-                            item_list[0][key][attrib_key]:
-                                src_el = et.SubElement(item_el, \
-                                                       "conceptSource")
-                                src_el.set("id", str(id_cnt))
-                                concept_source_ids[item_list[0][key]\
-                                                   [attrib_key]] = id_cnt
-                                id_cnt += 1
-                                src_el.set("resolves-to", \
-                                           "org.openmrs.ConceptSource")
-                                src_el.set("uuid", item_list[2][src_key]\
-                                           ["uuid"])
-                                for src_att_key in item_list[2][src_key]\
-                                .keys():
-                                    if src_att_key == "uuid":
-                                        continue
-                                    src_att_el = et.SubElement(src_el, \
-                                                    camel_case(src_att_key))
-                                    src_att_el.text = \
-                                    item_list[2][src_key][src_att_key]
-                                break
-                    else:
+                    if val in concept_source_ids:
+                        src_el = et.SubElement(item_el, "conceptSource")
+                        src_el.set("reference", str(concept_source_ids[val]))
+                    elif val in src_by_id:
+                        src = src_by_id[val]
                         src_el = et.SubElement(item_el, "conceptSource")
-                        src_el.set("reference",
-                                   str(concept_source_ids[item_list[0][key]\
-                                                          [attrib_key]]))
+                        src_el.set("id", str(id_cnt))
+                        concept_source_ids[val] = id_cnt
+                        id_cnt += 1
+                        src_el.set("resolves-to", "org.openmrs.ConceptSource")
+                        src_el.set("uuid", src["uuid"])
+                        for src_att_key, src_val in src.items():
+                            if src_att_key == "uuid":
+                                continue
+                            src_att_el = et.SubElement(src_el,
+                                                       camel_case(src_att_key))
+                            src_att_el.text = src_val
             el = et.SubElement(item_el, camel_case(attrib_key))
-            el.text = item_list[0][key][attrib_key]
+            el.text = val
 
     return id_cnt
 
 def build_ref_dict_items(ref_dicts, dict_item):
-    for key in dict_item[0]:
-        if dict_item[1] == "ReferenceTerm":
-            ref_dicts[dict_item[1]][dict_item[0][key][dict_item[2]]] = \
-                      ref_dicts["Source"][dict_item[0][key][dict_item[3]]] + \
-                      ":" + dict_item[0][key][dict_item[4]]
-        else:
-            ref_dicts[dict_item[1]][dict_item[0][key][dict_item[2]]] = \
-                      dict_item[0][key][dict_item[3]]
+    items, name, id_field, value_field = dict_item[:4]
+    target = ref_dicts[name]
+
+    if name == "ReferenceTerm":
+        sources = ref_dicts["Source"]
+        code_field = dict_item[4]
+        for item in items.values():
+            target[item[id_field]] = sources[item[value_field]] + ":" + \
+                                     item[code_field]
+    else:
+        for item in items.values():
+            target[item[id_field]] = item[value_field]
         
 def build_ref_dicts(ref_dicts, datatypes, classes, map_types, ref_sources,
                     ref_terms):
@@ -309,126 +313,131 @@ def build_ref_dicts(ref_dicts, datatypes, classes, map_types, ref_sources,
          (ref_terms, "ReferenceTerm", "concept_reference_term_id",
           "concept_source_id", "code")]
     for dict_item in dict_metadata:
-        if dict_item[1] not in ref_dicts.keys():
+        if dict_item[1] not in ref_dicts:
             ref_dicts[dict_item[1]] = dict()
         build_ref_dict_items(ref_dicts, dict_item)
     
+@lru_cache(maxsize=None)
 def camel_case(st):
-    output = ''.join(x for x in st.title() if x.isalnum())
-    return output[0].lower() + output[1:]
-
-def convert_concept_xml_to_csv(concept_xml_filenames, output_path,
+    # Column names only ever contain [a-z0-9_], so dropping the underscores
+    # leaves just the alphanumerics
+    output = st.title().replace("_", "")
+    return output[:1].lower() + output[1:]
+
+def convert_concept_xml_file_to_csv(xml_filename, numeric_concepts,
+                                    concepts_output_path, regexes):
+    # Reads the parsed files and reference dictionaries from
+    # _pool_parsed_files and _pool_ref_dicts
+    parsed = _pool_parsed_files[xml_filename]
+    ref_dicts = _pool_ref_dicts
+    concepts = parsed["concepts"]
+
+    matches = regexes["concepts_filename"].match(xml_filename)
+    name = matches.group(1)
+    version = matches.group(2)
+
+    if numeric_concepts is not None:
+        for attribs in _pool_parsed_files[numeric_concepts]["numerics"]:
+            concepts[attribs["concept_id"]].update(attribs)
+
+    concept_csv = dict()
+    build_concept_csv(concept_csv, concepts, parsed["descriptions"],
+                      parsed["answers"], parsed["names"], parsed["ref_maps"],
+                      parsed["sets"], ref_dicts)
+
+    # Need to make sure any concepts with 'Answers' or 'Members' get
+    # defined after the definitions of those constituent concepts
+    final_concept_csv = dict()
+    for key in concept_csv:
+        if key in final_concept_csv:
+            continue
+        order_final_concepts(final_concept_csv, concept_csv, key)
+
+    # Collect the headers in first-seen order, using a dict as an
+    # ordered set
+    header_set = dict()
+    for row in concept_csv.values():
+        header_set.update(dict.fromkeys(row))
+    header_data = list(header_set)
+
+    header_data.append("_version:" + version)
+    header_data.append("_order:0")
+
+    # Lay each row out in header order so they can be written in bulk
+    header_idx = dict((header, i) for i, header in enumerate(header_data))
+    csv_rows = []
+    for row in final_concept_csv.values():
+        csv_row = [""] * len(header_data)
+        for csv_key, val in row.items():
+            csv_row[header_idx[csv_key]] = val
+        csv_rows.append(csv_row)
+
+    with open(concepts_output_path + "/" + name + ".csv", 'w',
+              newline="") as concept_csv_file:
+        writer = csv.writer(concept_csv_file,
+                            quoting=csv.QUOTE_NONNUMERIC)
+
+        writer.writerow(header_data)
+        writer.writerows(csv_rows)
+
+def convert_concept_xml_to_csv(concept_xml_filenames, parsed_files,
                                concepts_output_path, concept_processing_order,
                                regexes, ref_dicts):
-    ordered_xml_filenames = []
-    for order_re in concept_processing_order:
-        ordered_xml_filenames += [i for i in concept_xml_filenames
-                                  if order_re.search(i)]
+    global _pool_parsed_files, _pool_ref_dicts
 
+    order_searches = [order_re.search for order_re in concept_processing_order]
+    ordered_xml_filenames = [i for order_search in order_searches
+                             for i in concept_xml_filenames
+                             if order_search(i)]
+
+    main_concepts_match = regexes["main_concepts_file"].match
+    numeric_concepts_search = regexes["numeric_concepts"].search
+    numeric_concepts = next((i for i in concept_xml_filenames
+                             if numeric_concepts_search(i)), None)
+
+    # The numeric attributes are merged into the main concepts file
+    tasks = []
     for xml_filename in ordered_xml_filenames:
-        concepts = dict()
-        descriptions = dict()
-        answers = dict()
-        names = dict()
-        ref_maps = dict()
-        sets = dict()
-    
-        matches = regexes["concepts_filename"].match(xml_filename)
-        name = matches.group(1)
-        version = matches.group(2)
-        
-        tree = et.parse(output_path + "/" + xml_filename)
-
-        for concept_el in tree.findall('concept'):
-            if concept_el.get("concept_id") in concepts.keys():
-                continue
-            concepts[concept_el.get("concept_id")] = concept_el.attrib
-
-        for description_el in tree.findall('concept_description'):
-            if description_el.get("uuid") in descriptions.keys():
-                continue
-            descriptions[description_el.get("uuid")] = \
-            description_el.attrib
-
-        for answer_el in tree.findall('concept_answer'):
-            if answer_el.get("uuid") in answers.keys():
-                continue
-            answers[answer_el.get("uuid")] = answer_el.attrib
-
-        for name_el in tree.findall('concept_name'):
-            if name_el.get("uuid") in names.keys():
-                continue
-            names[name_el.get("uuid")] = name_el.attrib
-
-        for ref_map_el in tree.findall('concept_reference_map'):
-            if ref_map_el.get("uuid") in ref_maps.keys():
-                continue
-            ref_maps[ref_map_el.get("uuid")] = ref_map_el.attrib
-
-        for set_el in tree.findall('concept_set'):
-            if set_el.get("uuid") in sets.keys():
-                continue
-            sets[set_el.get("uuid")] = set_el.attrib
-    
-        if regexes["main_concepts_file"].match(xml_filename):
-            numeric_concepts = [i for i in concept_xml_filenames
-                                if regexes["numeric_concepts"].search(i)][0]
-            
-            numeric_tree = et.parse(output_path + "/" + numeric_concepts)
-
-            for numeric_el in numeric_tree.findall('concept_numeric'):
-                concepts[numeric_el.get("concept_id")].\
-                update(numeric_el.attrib)
-            
-            os.remove(output_path + '/' + numeric_concepts)
-
-        concept_csv = dict()
-        build_concept_csv(concept_csv, concepts, descriptions,
-                          answers, names, ref_maps, sets, ref_dicts)
-
-        # Need to make sure any concepts with 'Answers' or 'Members' get
-        # defined after the definitions of those constituent concepts
-        final_concept_csv = dict()
-        for key in concept_csv.keys():
-            if key in final_concept_csv.keys():
-                continue
-            order_final_concepts(final_concept_csv, concept_csv, key)
-
-        header_data = []
-        for key in concept_csv.keys():
-            for csv_key in concept_csv[key].keys():
-                if csv_key not in header_data:
-                    header_data.append(csv_key)
-
-        header_data.append("_version:" + version)
-        header_data.append("_order:0")
-
-        with open(concepts_output_path + "/" + name + ".csv", 'w',
-                  newline="") as concept_csv_file:
-            writer = csv.DictWriter(concept_csv_file, fieldnames=header_data,
-                                    quoting=csv.QUOTE_NONNUMERIC)
-
-            writer.writeheader()
-            for key in final_concept_csv.keys():
-                writer.writerow(final_concept_csv[key])
-    
-        os.remove(output_path + '/' + xml_filename)
+        if main_concepts_match(xml_filename):
+            tasks.append((xml_filename, numeric_concepts,
+                          concepts_output_path, regexes))
+        else:
+            tasks.append((xml_filename, None, concepts_output_path, regexes))
+
+    _pool_parsed_files = parsed_files
+    _pool_ref_dicts = ref_dicts
+
+    # Each file is converted independently. Forked workers inherit the
+    # parsed data, so only the filenames are sent to them; without fork,
+    # or with nothing to overlap, convert in this process
+    try:
+        if "fork" in mp.get_all_start_methods() and \
+           (os.cpu_count() or 1) > 1 and len(tasks) > 1:
+            with mp.get_context("fork").Pool(min(os.cpu_count(),
+                                                 len(tasks))) as pool:
+                pool.starmap(convert_concept_xml_file_to_csv, tasks)
+        else:
+            for task in tasks:
+                convert_concept_xml_file_to_csv(*task)
+    finally:
+        _pool_parsed_files = None
+        _pool_ref_dicts = None
 
 def order_final_concepts(final_concept_csv, concept_csv, key):
-    if "Members" in concept_csv[key].keys():
+    if "Members" in concept_csv[key]:
         for member in concept_csv[key]["Members"].split(";"):
-            for concept_key in concept_csv.keys():
+            for concept_key in concept_csv:
                 if concept_csv[concept_key]["Uuid"] == member:
-                    if concept_key in final_concept_csv.keys():
+                    if concept_key in final_concept_csv:
                         continue
                     order_final_concepts(final_concept_csv, concept_csv, 
                                          concept_key)
                     break
-    elif "Answers" in concept_csv[key].keys():
+    elif "Answers" in concept_csv[key]:
         for answer in concept_csv[key]["Answers"].split(";"):
-            for concept_key in concept_csv.keys():
+            for concept_key in concept_csv:
                 if concept_csv[concept_key]["Uuid"] == answer:
-                    if concept_key in final_concept_csv.keys():
+                    if concept_key in final_concept_csv:
                         continue
                     order_final_concepts(final_concept_csv, concept_csv, 
                                          concept_key)
@@ -439,10 +448,13 @@ def order_final_concepts(final_concept_csv, concept_csv, key):
 
     return
 
-def create_concept_metadata_mds_package(concept_xml_filenames, output_path,
+def create_concept_metadata_mds_package(concept_xml_filenames, parsed_files,
                                         mds_output_path, regexes, ref_dicts):
+    numeric_concepts_match = regexes["numeric_concepts"].match
+    concepts_filename_match = regexes["concepts_filename"].match
+
     for xml_filename in concept_xml_filenames:
-        if regexes["numeric_concepts"].match(xml_filename):
+        if numeric_concepts_match(xml_filename):
             continue
 
         datatypes = dict()
@@ -451,106 +463,66 @@ def create_concept_metadata_mds_package(concept_xml_filenames, output_path,
         ref_sources = dict()
         ref_terms = dict()
 
-        matches = regexes["concepts_filename"].match(xml_filename)
+        matches = concepts_filename_match(xml_filename)
         name = matches.group(1).replace("_", " ")
         desc = "Standard set of " + matches.group(1).replace("_", " ") + \
             " distributed with the Reference Application"
         version = matches.group(2)
         mds_filename = matches.group(1) + "-" + version + ".zip"
         
-        tree = et.parse(output_path + "/" + xml_filename)
-
-        for datatype_el in tree.findall('concept_datatype'):
-            if "Datatype" in ref_dicts.keys():
-                if datatype_el.get("concept_datatype_id") in \
-                ref_dicts["Datatype"].keys():
-                    continue
-            datatypes[datatype_el.get("uuid")] = datatype_el.attrib
-
-        for class_el in tree.findall('concept_class'):
-            if "Class" in ref_dicts.keys():
-                if class_el.get("concept_class_id") in \
-                ref_dicts["Class"].keys():
-                    continue
-            classes[class_el.get("uuid")] = class_el.attrib
-
-        for map_type_el in tree.findall('concept_map_type'):
-            if "MapType" in ref_dicts.keys():
-                if map_type_el.get("concept_map_type_id") in \
-                ref_dicts["MapType"].keys():
-                    continue
-            map_types[map_type_el.get("uuid")] = map_type_el.attrib
-
-        for ref_source_el in tree.findall('concept_reference_source'):
-#            if "Source" in ref_dicts.keys():
-#                if ref_source_el.get("concept_source_id") in \
-#                ref_dicts["Source"].keys():
-#                    continue
-            ref_sources[ref_source_el.get("uuid")] = ref_source_el.attrib
-
-        for ref_term_el in tree.findall('concept_reference_term'):
-            if "ReferenceTerm" in ref_dicts.keys():
-                if ref_term_el.get("concept_reference_term_id") in \
-                ref_dicts["ReferenceTerm"].keys():
-                    continue
-            ref_terms[ref_term_el.get("uuid")] = ref_term_el.attrib
+        parsed = parsed_files[xml_filename]
+        ingest_targets = [
+            (parsed["datatypes"], datatypes, "Datatype",
+             "concept_datatype_id"),
+            (parsed["classes"], classes, "Class", "concept_class_id"),
+            (parsed["map_types"], map_types, "MapType",
+             "concept_map_type_id"),
+            # Reference sources are always carried into each package
+            (parsed["ref_sources"], ref_sources, None, None),
+            (parsed["ref_terms"], ref_terms, "ReferenceTerm",
+             "concept_reference_term_id")]
+
+        for elements, target, ref_dict_name, id_field in ingest_targets:
+            for attribs in elements:
+                if ref_dict_name in ref_dicts:
+                    if attribs.get(id_field) in ref_dicts[ref_dict_name]:
+                        continue
+                target[attribs.get("uuid")] = attribs
     
         build_ref_dicts(ref_dicts, datatypes, classes, map_types, ref_sources,
                         ref_terms)
 
-        header_xml_content = \
-            build_concept_metadata_mds_header_xml(name, desc, version,
-                                                  datatypes, classes,
-                                                  map_types, ref_sources,
-                                                  ref_terms)
-        metadata_xml_content = \
-            build_concept_metadata_mds_metadata_xml(datatypes, classes,
-                                                    map_types, ref_sources,
-                                                    ref_terms)
-
-        xml_indent(header_xml_content)        
-        xml_indent(metadata_xml_content)
-
-        with zipfile.ZipFile(mds_output_path + "/" +
-                             mds_filename, "w") as mds_zip:
-            mds_zip.writestr("header.xml",
-                             et.tostring(header_xml_content,
-                                         encoding="unicode", method="xml"),
-                             compress_type=zipfile.ZIP_DEFLATED)
-            mds_zip.writestr("metadata.xml",
-                             et.tostring(metadata_xml_content,
-                                         encoding="unicode", method="xml"),
-                             compress_type=zipfile.ZIP_DEFLATED)
+        write_concept_metadata_mds_package(mds_output_path + "/" +
+                                           mds_filename, name, desc, version,
+                                           datatypes, classes, map_types,
+                                           ref_sources, ref_terms)
     
 def error(msg):
     print(msg)
     sys.exit()
 
-def extract_concept_xml_files(rmd_omod_file, concept_xml_filenames,
-                              output_path):
-    with zipfile.ZipFile(rmd_omod_file) as rmd_omod_zip:
-        for xml_filename in concept_xml_filenames:
-            rmd_omod_zip.extract(xml_filename, path=output_path)
-
 def extract_filenames_and_mds_jar(rmd_omod_file, mds_jar_filenames,
                                   concept_xml_filenames, output_path,
                                   use_pre_2x, regexes):
 
     with zipfile.ZipFile(rmd_omod_file) as rmd_omod_zip:
+        omod_filenames = rmd_omod_zip.namelist()
         mds_jar_filenames += list(filter(regexes["mds_jar"].match,
-                                         rmd_omod_zip.namelist()))
+                                         omod_filenames))
         temp_xml_filenames = list(filter(regexes["concept_xml"].match,
-                                         rmd_omod_zip.namelist()))
-        rmd_omod_zip.extract(mds_jar_filenames[0], path=output_path)
+                                         omod_filenames))
 
+        # Keep only the numeric concepts file for the OpenMRS version in use
         if use_pre_2x == 1:
-            concept_xml_filenames += \
-                [i for i in temp_xml_filenames
-                 if not regexes["post_2x"].search(i)]
+            excluded_search = regexes["post_2x"].search
         else:
-            concept_xml_filenames += \
-                [i for i in temp_xml_filenames
-                 if not regexes["pre_2x"].search(i)]            
+            excluded_search = regexes["pre_2x"].search
+        concept_xml_filenames += [i for i in temp_xml_filenames
+                                  if not excluded_search(i)]
+
+        rmd_omod_zip.extractall(path=output_path,
+                                members=[mds_jar_filenames[0]] +
+                                concept_xml_filenames)
 
 def extract_mds_packages(mds_jar_filenames, output_path, mds_output_path,
                          regexes):
@@ -566,6 +538,56 @@ def extract_mds_packages(mds_jar_filenames, output_path, mds_output_path,
     os.remove(output_path + '/' + mds_jar_filenames[0])
     os.rmdir(output_path + '/' + mds_jar_filenames[0].split("/", 1)[0])
 
+def iter_xml_attribs(xml_path, tags):
+    # Stream the file, yielding a copy of the attributes of each element
+    # whose tag is in tags and discarding elements once they are processed
+    if _HAVE_LXML:
+        for event, el in et.iterparse(xml_path, events=("end",), tag=tags):
+            yield el.tag, dict(el.attrib)
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+        return
+
+    # ElementTree has no getprevious(), so hold on to the root from the first
+    # start event and detach its processed children from it instead
+    root = None
+    for event, el in et.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = el
+            continue
+        if el.tag in tags:
+            yield el.tag, dict(el.attrib)
+        root.clear()
+
+def parse_concept_file(xml_path):
+    parsed = dict()
+    targets = dict()
+    for tag, (key, id_field) in _CONCEPT_XML_ELEMENTS.items():
+        parsed[key] = dict() if id_field else []
+        targets[tag] = (parsed[key], id_field)
+
+    for tag, attribs in iter_xml_attribs(xml_path, tuple(targets)):
+        target, id_field = targets[tag]
+        if id_field is None:
+            target.append(attribs)
+        else:
+            target.setdefault(attribs.get(id_field), attribs)
+
+    return parsed
+
+def parse_concept_xml_files(concept_xml_filenames, output_path):
+    # Parse every extracted concept file once for use by both the MDS and
+    # CSV conversions, removing the files once read
+    parsed_files = dict((i, parse_concept_file(output_path + "/" + i))
+                        for i in concept_xml_filenames)
+
+    for xml_filename in concept_xml_filenames:
+        os.remove(output_path + "/" + xml_filename)
+
+    return parsed_files
+
 def usage():
     print("""\
 Usage: """ + sys.argv[0] + """
@@ -581,37 +603,42 @@ required parameters:\n\
 """)
     sys.exit(2)
 
-def xml_indent(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            xml_indent(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
+def write_concept_metadata_mds_package(mds_zip_path, name, desc, version,
+                                       datatypes, classes, map_types,
+                                       ref_sources, ref_terms):
+    header_xml_content = \
+        build_concept_metadata_mds_header_xml(name, desc, version,
+                                              datatypes, classes,
+                                              map_types, ref_sources,
+                                              ref_terms)
+    metadata_xml_content = \
+        build_concept_metadata_mds_metadata_xml(datatypes, classes,
+                                                map_types, ref_sources,
+                                                ref_terms)
+
+    # Serialize straight into the compressed archive members rather than
+    # building each document as a string first
+    with zipfile.ZipFile(mds_zip_path, "w") as mds_zip:
+        for xml_filename, xml_content in [("header.xml", header_xml_content),
+                                          ("metadata.xml",
+                                           metadata_xml_content)]:
+            zip_info = zipfile.ZipInfo(xml_filename,
+                                       date_time=time.localtime()[:6])
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            zip_info.external_attr = 0o600 << 16
+            with mds_zip.open(zip_info, "w") as xml_file:
+                write_xml(xml_content, xml_file)
+
+def write_xml(elem, xml_file):
+    # Write elem to the binary file xml_file as UTF-8, indented by two
+    # spaces per level
+    if _HAVE_LXML:
+        et.ElementTree(elem).write(xml_file, encoding="utf-8", method="xml",
+                                   pretty_print=True)
     else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-            
-#def xml_indent(elem, level=0):
-#    i = "\n" + level*"  "
-#    j = "\n" + (level-1)*"  "
-#    if len(elem):
-#        if not elem.text or not elem.text.strip():
-#            elem.text = i + "  "
-#        if not elem.tail or not elem.tail.strip():
-#            elem.tail = i
-#        for subelem in elem:
-#            xml_indent(subelem, level+1)
-#        if not elem.tail or not elem.tail.strip():
-#            elem.tail = j
-#    else:
-#        if level and (not elem.tail or not elem.tail.strip()):
-#            elem.tail = j
-#    return elem        
+        et.indent(elem)
+        elem.tail = "\n"
+        et.ElementTree(elem).write(xml_file, encoding="utf-8", method="xml")
 
 def main(argv):
     use_pre_2x = 0
@@ -640,14 +667,10 @@ def main(argv):
         except OSError:
             error("Could not create output directory: " + path)
 
-    try:
-        rmd_omod_file = open(args[0])
-    except FileNotFoundError:
+    if not os.path.isfile(args[0]):
         error(args[0] + ': File does not exist')
-    except IOError:
+    elif not os.access(args[0], os.R_OK):
         error(args[0] + ': File is not accessible')
-    finally:
-        rmd_omod_file.close()
 
     mds_jar_filenames = []
     concept_xml_filenames = []
@@ -680,12 +703,12 @@ def main(argv):
     extract_mds_packages(mds_jar_filenames, output_path, mds_output_path,
                          regexes)
 
-    extract_concept_xml_files(args[0], concept_xml_filenames, output_path)
+    parsed_files = parse_concept_xml_files(concept_xml_filenames, output_path)
 
-    create_concept_metadata_mds_package(concept_xml_filenames, output_path,
+    create_concept_metadata_mds_package(concept_xml_filenames, parsed_files,
                                         mds_output_path, regexes, ref_dicts)
     
-    convert_concept_xml_to_csv(concept_xml_filenames, output_path,
+    convert_concept_xml_to_csv(concept_xml_filenames, parsed_files,
                                concepts_output_path, concept_processing_order,
                                regexes, ref_dicts)
 